@@ -5,9 +5,10 @@ import re
 import sys
 # import shutil
 import subprocess
+import threading
+import heapq
 # from itertools import product
 # from collections import deque
-import heapq
 import argparse
 
 # 1. Setup command-line argument parser
@@ -42,13 +43,29 @@ if not args.substitution_file:
         parser.error("one of the arguments -T/--term or -F/--term-file is required (or use -s)")
 # ------------------
 
+def is_goal_label(s):
+    # same as matching goal\d+ against the whole string, without the regex engine
+    return s.startswith("goal") and s[4:].isdigit()
+
+_NO_LABELS = frozenset()
 
 class Formula:
+    # fixed attribute layout, there is one instance per distinct subterm
+    __slots__ = ("id", "args", "is_var", "value", "is_goal_id",
+                 "_str", "_size", "_ground", "_labels", "_hash")
+
+    # canonical instances, see intern
+    _pool = {}
+
+    # terms are never mutated after construction, so everything derived
+    # from the tree (string form, size, hash, groundness, goal labels) is
+    # computed once here from the already cached values of the arguments
     def __init__(self, id, args):
         self.id = id
-        self.args = args
+        self.args = tuple(args)
         self.is_var = False
         self.value = None
+        self.is_goal_id = len(args) == 0 and is_goal_label(id)
         if len(args) == 0:
             if id.lower().startswith("numneg") or id.lower().startswith("negnum"):
                 self.value = -int(id[6:])
@@ -58,60 +75,97 @@ class Formula:
                 self.is_var = True
             # else:
             #     raise Exception(f"unknown constant: {id}")
+            self._str = id
+            self._size = 1
+            self._ground = not self.is_goal_id
+            self._labels = frozenset((id,)) if self.is_goal_id else _NO_LABELS
+        else:
+            self._str = f"{id}({','.join(arg._str for arg in self.args)})"
+            self._size = 1 + sum(arg._size for arg in self.args)
+            self._ground = all(arg._ground for arg in self.args)
+            # goal labels occurring in the term, shared with the
+            # arguments when possible
+            labels = _NO_LABELS
+            for arg in self.args:
+                if arg._labels:
+                    labels = labels | arg._labels if labels else arg._labels
+            self._labels = labels
+        self._hash = hash((id, tuple(arg._hash for arg in self.args)))
+
+    @classmethod
+    def intern(cls, id, args):
+        # hash-consing: structurally equal terms are the same object,
+        # so equal subterms are shared and == mostly reduces to is
+        args = tuple(args)
+        key = (id, args)
+        t = cls._pool.get(key)
+        if t is None:
+            t = cls._pool[key] = cls(id, args)
+        return t
         
     def __repr__(self):
-        if len(self.args) == 0:
-            return self.id
-        else:
-            return f"{self.id}({','.join(map(str, self.args))})"
+        return self._str
         
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, Formula):
             return False
-        return self.id == other.id and self.args == other.args
+        return self._hash == other._hash and self.id == other.id and self.args == other.args
     
     def __hash__(self):
-        return hash((self.id, tuple(self.args)))
+        return self._hash
     
     def size(self):
-        if len(self.args) == 0:
-            return 1
-        else:
-            return 1 + sum(arg.size() for arg in self.args)
+        return self._size
         
     def __lt__(self, other):
-        return str(self) < str(other)
+        return self._str < other._str
 
-def parse_formula(s):
-    s = s.replace(" ","")
-    word = ""
-    while s!="" and s[0] not in ['(',')',',']:
-        word += s[0]
-        s = s[1:]
-    if s == "":
-        return Formula(word, []), s
-    if s[0] == '(':
-        s = s[1:]
-        args = []
-        while True:
-            if s[0] == ')':
-                s = s[1:]
-                break
-            else:
-                arg, s = parse_formula(s)
-                args.append(arg)
-                if s[0] == ',':
-                    s = s[1:]
-        return Formula(word, args), s
-    else:
-        return Formula(word, []), s
+_TOKEN = re.compile(r'[(),]|[^(),\s]+')
+# a "lhs -> rhs" or "lhs <-> rhs" line, optionally numbered like Twee's "12. lhs -> rhs"
+_SUBST_LINE = re.compile(r'^[ \t]*(?:\d+\.[ \t]+)?(\S.*?)[ \t]*(?:<->|->)[ \t]*(\S.*?)[ \t]*$', re.M)
 
-def replace(term, old, new_term):
-    # term,rest = parse_formula(term_str)
-    # assert rest == ""
-    # new_term,rest = parse_formula(new)
-    # assert rest == ""
-    
+def parse_formula(s):
+    # tokenize once, then build the term with an explicit stack
+    # of open argument lists (one per unclosed '(')
+    stack = [[]]
+    names = []
+    word = None
+    prev = None
+    for tok in _TOKEN.findall(s.replace(" ", "")):
+        if tok == '(':
+            if word is None:
+                raise Exception(f"parsing error: '(' without function name in {s}")
+            names.append(word)
+            stack.append([])
+            word = None
+        elif tok == ',' or tok == ')':
+            if word is not None:
+                stack[-1].append(Formula.intern(word, []))
+                word = None
+            if tok == ')':
+                if not names:
+                    raise Exception(f"parsing error: unbalanced ')' in {s}")
+                args = stack.pop()
+                stack[-1].append(Formula.intern(names.pop(), args))
+        else:
+            if prev is not None and prev != '(' and prev != ',':
+                raise Exception(f"parsing error: unexpected '{tok}' in {s}")
+            # the same few names occur in thousands of nodes, share one
+            # string object per name so id comparisons are mostly identity checks
+            word = sys.intern(tok)
+        prev = tok
+    if names:
+        raise Exception(f"parsing error: unbalanced '(' in {s}")
+    if word is not None:
+        stack[0].append(Formula.intern(word, []))
+    if len(stack[0]) != 1:
+        raise Exception(f"parsing error: expected a single term in {s}")
+    return stack[0][0]
+
+def replace(term, bindings):
+    # substitutes all goals in bindings (goal label -> term) in one pass
     # def replace_rec(t):
     #     if t.id == old and len(t.args) == 0:
     #         return new_term
@@ -122,64 +176,94 @@ def replace(term, old, new_term):
     # return str(replaced)
     # return replaced
     
-    def replace_rec_inline(t):
-        if t.id == old and len(t.args) == 0:
-            return new_term
-        else:
-            for i in range(len(t.args)):
-                t.args[i] = replace_rec_inline(t.args[i])
-            return t
-    return replace_rec_inline(term)
+    # isdisjoint on a dict view iterates the smaller side, on the dict
+    # itself it would iterate all bindings
+    goals = bindings.keys()
+
+    if goals.isdisjoint(term._labels):
+        return term
+    if len(term.args) == 0:
+        return bindings[term.id]
+
+    # post-order walk with an explicit stack of (node, rewritten args so far),
+    # only nodes containing a goal are pushed, so each of them is rebuilt
+    # (instead of mutated, the cached fields of t stay valid)
+    stack = [(term, [])]
+    while True:
+        t, new_args = stack[-1]
+        if len(new_args) < len(t.args):
+            arg = t.args[len(new_args)]
+            if goals.isdisjoint(arg._labels):
+                # no goal to replace below arg, skip the whole subtree
+                new_args.append(arg)
+            elif len(arg.args) == 0:
+                new_args.append(bindings[arg.id])
+            else:
+                stack.append((arg, []))
+            continue
+        stack.pop()
+        new_t = Formula.intern(t.id, new_args)
+        if not stack:
+            return new_t
+        stack[-1][1].append(new_t)
+
+def scan_substitutions(text):
+    # yields (lhs, rhs, line) for every rewrite line of text in one regex pass,
+    # and (None, None, line) for the other non-empty lines
+    pos = 0
+    for m in _SUBST_LINE.finditer(text):
+        if m.start() > pos:
+            for line in text[pos:m.start()].split("\n"):
+                if line.strip():
+                    yield None, None, line.strip()
+        pos = m.end()
+        yield m.group(1), m.group(2), m.group(0).strip()
+    for line in text[pos:].split("\n"):
+        if line.strip():
+            yield None, None, line.strip()
 
 # -----------------------------------------------------------------
 # Main script logic
 # -----------------------------------------------------------------
 
-subst_set = []
-pattern = re.compile(r'goal\d+')
+# (lhs, rhs) -> None, a dict to drop the duplicates in Twee's output
+# while keeping the input order
+subst_set = {}
+
+def add_substitution(lhs, rhs):
+    # the resolver treats both sides alike, so a rule that was already
+    # added the other way round is a duplicate as well
+    if (rhs, lhs) not in subst_set:
+        subst_set[(lhs, rhs)] = None
 
 if args.substitution_file:
     # --- PATH 1: Load substitutions from file ---
     print(f"Loading substitutions from {args.substitution_file}...")
     try:
         with open(args.substitution_file, 'r') as f:
-            lines = f.readlines()
-            # skip all lines until we find a line starting with "Substitutions found:"
-            # end at line Resolving
-            start_idx = 0
-            end_idx = len(lines)
-            for i, line in enumerate(lines):
-                if line.startswith("Substitutions found:"):
-                    start_idx = i + 1
-                if line.startswith("Resolving"):
-                    end_idx = i
-                    break
-            lines = lines[start_idx:end_idx]
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # Parse the "lhs -> rhs" or "lhs <-> rhs" format
-                if "<->" in line:
-                    lhs, rhs = line.split(" <-> ")
-                elif "->" in line:
-                    lhs, rhs = line.split(" -> ")
-                else:
-                    print(f"Warning: Skipping malformed line in substitution file: {line}", file=sys.stderr)
-                    continue
-                
-                lhs = lhs.strip()
-                rhs = rhs.strip()
-                
-                if lhs == rhs:
-                    continue
-                
-                # only add if one side is pattern goal\d+
-                if pattern.match(lhs) or pattern.match(rhs):
-                    subst_set.append((lhs, rhs))
-                else:
-                    print(f"Warning: Skipping line (no goal pattern): {line}", file=sys.stderr)
+            text = f.read()
+        # skip everything until the last line starting with "Substitutions found:"
+        # end at the first line starting with Resolving
+        end = re.search(r'^Resolving', text, re.M)
+        if end:
+            text = text[:end.start()]
+        starts = [m.end() for m in re.finditer(r'^Substitutions found:.*$', text, re.M)]
+        if starts:
+            text = text[starts[-1]:]
+
+        for lhs, rhs, line in scan_substitutions(text):
+            if lhs is None:
+                print(f"Warning: Skipping malformed line in substitution file: {line}", file=sys.stderr)
+                continue
+            
+            if lhs == rhs:
+                continue
+            
+            # only add if one side is pattern goal\d+
+            if is_goal_label(lhs) or is_goal_label(rhs):
+                add_substitution(parse_formula(lhs), parse_formula(rhs))
+            else:
+                print(f"Warning: Skipping line (no goal pattern): {line}", file=sys.stderr)
 
     except FileNotFoundError:
         print(f"Error: Substitution file not found: {args.substitution_file}", file=sys.stderr)
@@ -215,44 +299,60 @@ else:
         print("Error: No term provided or term file was empty.", file=sys.stderr)
         sys.exit(1)
 
-    term,rest = parse_formula(term_string)
-    if rest != "":
-        raise Exception("parsing error")
+    term = parse_formula(term_string)
 
     with open(rule_file, "r") as f:
         data = f.read()
 
     goals = []
     
+    # subterm -> the goal constant standing for it, keyed on the
+    # Formula itself (cached hash) instead of its string form
     created_subterms = {}
+    # flattened subterm (arguments replaced by their goals) -> its goal constant
+    flattened_subterms = {}
     
-    def collect_subterms(t, idx):
-        # use index,
-        # return next free index and the constant representing t
-        if str(t) in created_subterms:
-            # no index used, so idx is the next free
-            return idx, created_subterms[str(t)]
-        if idx > 0 and len(t.args) == 0:
-            # no index used, use term directly
-            return idx, t.id
-        # idx is reserved for this term
-        current_idx = idx+1
-        new_args = []
-        for arg in t.args:
-            current_idx, subterm = collect_subterms(arg, current_idx)
-            new_args.append(subterm)
-        name = f"goal{idx}"
-        subterm = Formula(t.id, new_args)
-        subst_set.append((name, str(subterm)))
-        goals.append(f'% {name} represents {t}')
-        goals.append(f'cnf(goal,axiom, {name} = {subterm}).')
-        created_subterms[str(t)] = name
-        return current_idx, name
+    def collect_subterms(term):
+        # every non-constant subterm gets a goal constant, the indices are
+        # handed out in pre-order and the goals emitted in post-order;
+        # explicit stack of (term, its goal name, flattened args so far)
+        next_idx = 1
+        stack = [(term, "goal0", [])]
+        while stack:
+            t, name, new_args = stack[-1]
+            if len(new_args) < len(t.args):
+                arg = t.args[len(new_args)]
+                if arg in created_subterms:
+                    # no index used
+                    new_args.append(created_subterms[arg])
+                elif len(arg.args) == 0:
+                    # no index used, use term directly
+                    new_args.append(arg)
+                else:
+                    stack.append((arg, sys.intern(f"goal{next_idx}"), []))
+                    next_idx += 1
+                continue
+            stack.pop()
+            subterm = Formula.intern(t.id, new_args)
+            if stack and subterm in flattened_subterms:
+                # same shape as an earlier subterm, share its goal instead
+                # of sending an equivalent one to Twee (name stays unused);
+                # the root is always emitted as goal0
+                goal = flattened_subterms[subterm]
+            else:
+                goal = Formula.intern(name, [])
+                add_substitution(goal, subterm)
+                goals.append(f'% {name} represents {t._str}')
+                goals.append(f'cnf(goal,axiom, {name} = {subterm._str}).')
+                flattened_subterms[subterm] = goal
+            created_subterms[t] = goal
+            if stack:
+                stack[-1][2].append(goal)
 
     if flatten:
-        collect_subterms(term, 0)
+        collect_subterms(term)
     else:
-        goals.append('cnf(goal,axiom, goal0 = '+str(term)+').')
+        goals.append('cnf(goal,axiom, goal0 = '+term._str+').')
 
     goals.append('cnf(goal,conjecture, zero = one).')
     print("Generated goals:")
@@ -273,70 +373,94 @@ else:
             f.write(data)
         print("Wrote Twee input to twee_input.p")
         
-    proc = subprocess.Popen(["./twee.sh", str(timeout), "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate(input=data.encode())
-
-    output = out.decode()
-    if os.getenv("DEBUG"):
-        with open("twee_output.txt", "w") as f:
-            f.write(output)
-        print("Wrote Twee output to twee_output.txt")
-    
-    if True:
-        limiter="Goal 1 (goal): zero = one."
-        if limiter not in output:
-            print("Error: Could not find Twee output limiter. Twee may have failed.", file=sys.stderr)
-            print("\n--- Twee stdout: ---", file=sys.stderr)
-            print(out.decode(), file=sys.stderr)
-            print("\n--- Twee stderr: ---", file=sys.stderr)
-            print(err.decode(), file=sys.stderr)
-            sys.exit(1)
-            
-        output = output.split(limiter)[1]
-        
-    lines = output.split("\n")
-    # lines = [line for line in lines if "goal" in line]
-    # subst_set = {}
-    
-    for line in lines:
-        # print(line)
-        # if "->" not in line:
-        #     continue
+    def add_twee_substitution(line):
+        # called for every streamed line, most of which mention no goal
         if "goal" not in line:
+            return
+        m = _SUBST_LINE.match(line)
+        if not m:
+            return
+        lhs, rhs = m.groups()
+        # only add if one side is pattern goal\d+
+        if not (is_goal_label(lhs) or is_goal_label(rhs)):
+            return
+        lhs = parse_formula(lhs)
+        rhs = parse_formula(rhs)
+        if lhs != rhs:
+            add_substitution(lhs, rhs)
+
+    proc = subprocess.Popen(["./twee.sh", str(timeout), "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            encoding="utf-8", bufsize=1)
+
+    # feed the input and collect stderr in the background, so that the
+    # output can be parsed line by line while Twee is still running
+    def write_input():
+        try:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    err_chunks = []
+    threads = [threading.Thread(target=write_input, daemon=True),
+               threading.Thread(target=lambda: err_chunks.append(proc.stderr.read()), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    debug_output = open("twee_output.txt", "w") if os.getenv("DEBUG") else None
+
+    # the substitutions are the lines between the first and the second
+    # occurrence of the limiter, the output before it is only kept for
+    # the error message
+    limiter="Goal 1 (goal): zero = one."
+    head = []
+    found = False
+    done = False
+    for line in proc.stdout:
+        if debug_output:
+            debug_output.write(line)
+        if done:
             continue
-        # remove "\d+\. " at start of line
-        line = re.sub(r"^\s*\d+\.\s+", "", line)
-        if "<->" in line:
-            lhs, rhs = line.split(" <-> ")
-        elif "->" in line:
-            lhs, rhs = line.split(" -> ")
-        else:
-            continue
-        
-        lhs = lhs.strip()
-        rhs = rhs.strip()
-        if lhs == rhs:
+        if not found:
+            if limiter not in line:
+                head.append(line)
+                continue
+            found = True
+            line = line.split(limiter, 1)[1]
+        if limiter in line:
+            add_twee_substitution(line.split(limiter, 1)[0])
+            done = True
+            if not debug_output:
+                # nothing after this is used, no need to wait for Twee
+                proc.terminate()
+                break
             continue
-        # only add if one side is pattern goal\d+
-        if re.match(r'goal\d+', lhs) or re.match(r'goal\d+', rhs):
-            subst_set.append((lhs, rhs))
+        add_twee_substitution(line)
+    proc.stdout.close()
+    proc.wait()
+    for thread in threads:
+        thread.join()
+
+    if debug_output:
+        debug_output.close()
+        print("Wrote Twee output to twee_output.txt")
+    
+    if not found:
+        print("Error: Could not find Twee output limiter. Twee may have failed.", file=sys.stderr)
+        print("\n--- Twee stdout: ---", file=sys.stderr)
+        print("".join(head), file=sys.stderr)
+        print("\n--- Twee stderr: ---", file=sys.stderr)
+        print("".join(err_chunks), file=sys.stderr)
+        sys.exit(1)
     
 # -----------------------------------------------------------------
 # Resolver logic (common to both paths)
 # -----------------------------------------------------------------
 
 def is_ground(term):
-    if len(term.args) == 0:
-        return not pattern.match(term.id)
-    return all(is_ground(arg) for arg in term.args)
+    return term._ground
 
 def is_goal(term):
-    return len(term.args) == 0 and pattern.match(term.id)
-
-def contains_label(term, label):
-    if term.id == label:
-        return True
-    return any(contains_label(arg, label) for arg in term.args)
+    return term.is_goal_id
 
 # filter recursive ones
 # new_subst_set = []
@@ -351,97 +475,135 @@ def contains_label(term, label):
 # subst_set = new_subst_set
 # sys.exit(0)
     
+# the hot format strings use the cached _str directly, formatting a
+# Formula would go through __format__, __str__ and __repr__
 print("\nSubstitutions found:")
 for lhs, rhs in subst_set:
-    print(f"  {lhs} -> {rhs}")
+    print(f"  {lhs._str} -> {rhs._str}")
 
 # we have for each goal one or multiple substitutions (potentially just other goal)
 # we want to find a order (starting at goal0) to resolve these substitutions to reach a final term
 # without any remaining goals
 
 # inverse topo sort + dijkstra:
-# start with leaf nodes in priorityqueue (sorted by size)
+# start with leaf nodes in priorityqueue (bucketed by size)
 # replace in all other nodes, continue
 
-new_subst_set = []
-for lhs_str, rhs_str in subst_set:
-    lhs, rest = parse_formula(lhs_str)
-    assert rest == ""
-    rhs, rest = parse_formula(rhs_str)
-    assert rest == ""
-    if (pattern.match(lhs.id) and contains_label(rhs, lhs.id)) or \
-        (pattern.match(rhs.id) and contains_label(lhs, rhs.id)):
+new_subst_set = {}
+for lhs, rhs in subst_set:
+    if (lhs.is_goal_id and lhs.id in rhs._labels) or \
+        (rhs.is_goal_id and rhs.id in lhs._labels):
         continue
-    new_subst_set.append((lhs, rhs))
+    new_subst_set[(lhs, rhs)] = None
 subst_set = new_subst_set
     
-queue = []
-subst = {}
-remaining = set()
-for lhs, rhs in subst_set:
-    if is_ground(rhs):
-        assert is_goal(lhs)
-        heapq.heappush(queue, (rhs.size(), lhs.id, rhs))
-    elif is_ground(lhs):
-        assert is_goal(rhs)
-        heapq.heappush(queue, (lhs.size(), rhs.id, lhs))
-    else:
-        remaining.add((lhs, rhs))
-# print("initially remaining substitutions:")
-# for lhs, rhs in remaining:
-#     print(f"  {lhs} -> {rhs}")
-
-while queue:
-    _, g, t = heapq.heappop(queue)
-    assert is_ground(t)
-    if g in subst:
-        # we already found a smaller term for this goal
-        continue
-    print(f"Resolving {g} -> {t}")
-    subst[g] = t
-    new_remaining = set()
-    for lhs, rhs in remaining:
-        if lhs == g or rhs == g:
-            # we already found a smaller term for this goal
-            continue
-        # new_lhs = lhs.replace(g, t)
-        # new_rhs = rhs.replace(g, t)
-        new_lhs = replace(lhs, g, t)
-        new_rhs = replace(rhs, g, t)
-        # if (lhs != new_lhs or rhs != new_rhs) and (g == "goal80"):
-        #     print(f"  Updated: {lhs} -> {rhs}  to  {new_lhs} -> {new_rhs}")
-        if is_ground(new_rhs):
-            if is_goal(new_lhs):
-                heapq.heappush(queue, (new_rhs.size(), new_lhs.id, new_rhs))
-            else:
-                # we have a ground term and a non-goal term => replaced goal with ground term
-                # we might have replaced the goal side => other side not necessarily ground
-                # if not is_ground(new_lhs):
-                #     print(f"Warning: Replaced goal with ground term but LHS is not ground: {new_lhs} -> {new_rhs}")
-                #     print(f"Was before: {lhs} -> {rhs}, replaced {g} with {t}")
-                # assert is_ground(new_lhs)
+def resolve(subst_set):
+    # the resolver loop runs in a function, so all of its state lives in
+    # fast local variables instead of module globals;
+    # returns the resolved goals and the pairs that could not be resolved
+
+    # bucket queue on the term size: buckets[size] maps each goal to its
+    # smallest candidate term of that size (ties broken by the string form);
+    # sizes can grow exponentially with the nesting of goals, so buckets only
+    # exist for sizes that were pushed and a heap holds those sizes
+    buckets = {}
+    sizes = []
+
+    def push(size, g, t):
+        bucket = buckets.get(size)
+        if bucket is None:
+            bucket = buckets[size] = {}
+            heapq.heappush(sizes, size)
+        best = bucket.get(g)
+        if best is None or t < best:
+            bucket[g] = t
+
+    subst = {}
+    # pairs that still contain goals on both sides, by pair id, and for each
+    # goal label the ids of the pairs it occurs in
+    remaining = {}
+    label_to_pairs = {}
+    for lhs, rhs in subst_set:
+        if is_ground(rhs):
+            assert is_goal(lhs)
+            push(rhs.size(), lhs.id, rhs)
+        elif is_ground(lhs):
+            assert is_goal(rhs)
+            push(lhs.size(), rhs.id, lhs)
+        else:
+            pair_id = len(remaining)
+            remaining[pair_id] = (lhs, rhs)
+            for label in lhs._labels | rhs._labels:
+                label_to_pairs.setdefault(label, set()).add(pair_id)
+    # print("initially remaining substitutions:")
+    # for lhs, rhs in remaining.values():
+    #     print(f"  {lhs} -> {rhs}")
+
+    while sizes:
+        # every term pushed while resolving has at least the size of the
+        # resolved term, so all entries of the smallest size can be resolved
+        # together and substituted in a single pass over remaining
+        size = heapq.heappop(sizes)
+        # terms of the same size pushed below go to a fresh bucket
+        bucket = buckets.pop(size)
+        batch = {}
+        for g in sorted(bucket):
+            t = bucket[g]
+            assert is_ground(t)
+            if g in subst:
+                # we already found a smaller term for this goal
                 continue
-        elif is_ground(new_lhs):
-            if is_goal(new_rhs):
-                heapq.heappush(queue, (new_lhs.size(), new_rhs.id, new_lhs))
-            else:
-                # we have a ground term and a non-goal term => replaced goal with ground term
-                # assert is_ground(new_rhs)
+            print(f"Resolving {g} -> {t._str}")
+            batch[g] = t
+        subst.update(batch)
+        # only the pairs mentioning a resolved goal change, the index entries
+        # of a changed pair stay valid for its remaining labels (the inserted
+        # terms are ground) and entries of dropped pairs are skipped here
+        affected = set()
+        for g in batch:
+            affected.update(label_to_pairs.pop(g, ()))
+        for pair_id in affected:
+            if pair_id not in remaining:
                 continue
-        else:
-            new_remaining.add((new_lhs, new_rhs))
-    remaining = new_remaining
-            
+            lhs, rhs = remaining.pop(pair_id)
+            new_lhs = replace(lhs, batch)
+            new_rhs = replace(rhs, batch)
+            if is_ground(new_rhs):
+                if is_goal(new_lhs):
+                    push(new_rhs.size(), new_lhs.id, new_rhs)
+                else:
+                    # we have a ground term and a non-goal term => replaced goal with ground term
+                    # we might have replaced the goal side => other side not necessarily ground
+                    # if not is_ground(new_lhs):
+                    #     print(f"Warning: Replaced goal with ground term but LHS is not ground: {new_lhs} -> {new_rhs}")
+                    #     print(f"Was before: {lhs} -> {rhs}, replaced {g} with {t}")
+                    # assert is_ground(new_lhs)
+                    continue
+            elif is_ground(new_lhs):
+                if is_goal(new_rhs):
+                    push(new_lhs.size(), new_rhs.id, new_lhs)
+                else:
+                    # we have a ground term and a non-goal term => replaced goal with ground term
+                    # assert is_ground(new_rhs)
+                    continue
+            else:
+                remaining[pair_id] = (new_lhs, new_rhs)
+    return subst, remaining
+
+subst, remaining = resolve(subst_set)
+
 print("\nFinal substitutions:")
 for lhs, rhs in subst.items():
-    print(f"  {lhs} -> {rhs}")
+    print(f"  {lhs} -> {rhs._str}")
+
+goal0 = Formula.intern("goal0", [])
 
 print("\nResolved term for goal0:")
 if "goal0" in subst:
     print(subst["goal0"])
 else:
     print("Error: Could not resolve goal0.")
-    if not args.substitution_file and "goal0" not in [l for l,r in subst_set] + [r for l,r in subst_set]:
+    if not args.substitution_file and goal0 not in [l for l,r in subst_set] + [r for l,r in subst_set]:
          print("Note: 'goal0' was not found in Twee output.")
     elif not subst_set:
          print("Note: No substitutions were found or provided.")
@@ -449,11 +611,11 @@ else:
          print("Note: Resolution may have failed or goal0 was not in the set.")
          print("Best effort result:")
          goals = []
-         for lhs, rhs in remaining:
-             if lhs == "goal0":
+         for lhs, rhs in remaining.values():
+             if lhs == goal0:
                 goals.append(rhs)
-             elif rhs == "goal0":
+             elif rhs == goal0:
                 goals.append(lhs)
                 #  print(f"  {lhs} -> {rhs}")
          if goals:
-            print(min(goals, key=len))
\ No newline at end of file
+            print(min(goals, key=Formula.size))
\ No newline at end of file